@@ -1,18 +1,31 @@
 import logging
 import asyncio
-import json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaVideo, BotCommand
+import html
+import re
+import signal
+from collections import namedtuple
+import orjson
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaAudio, InputMediaDocument, InputMediaVideo, BotCommand
+)
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler, # Ensure 'filters' is lowercase here
-    ContextTypes, ConversationHandler
+    ContextTypes, ConversationHandler, AIORateLimiter
 )
 from telegram.constants import ParseMode, ChatType
 from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+from bson import ObjectId
+from bson.errors import InvalidId
+from cachetools import LRUCache, TTLCache
 
 import config
 import database as db
-from utils import parse_filename, generate_verification_token, shorten_link, get_verification_callback_url, format_bytes
-from webserver import web_app, set_telegram_bot, run_webserver # Import web_app for running it
+from utils import (
+    parse_filename, generate_verification_token, shorten_link, get_verification_callback_url, format_bytes,
+    pack_callback_data, unpack_callback_data, close_http_client
+)
+from webserver import set_telegram_bot, create_embedded_webserver
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -21,66 +34,307 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Constants for Callback Data and Conversation Handler States ---
-SEARCH_PREFIX = "search_"
-FILTER_PREFIX = "filter_"
-PAGE_PREFIX = "page_"
-DOWNLOAD_PREFIX = "dl_"
-CANCEL_PREFIX = "cancel_"
+# callback_data is a 1-byte action tag plus a binary payload, base64url encoded
+# (utils.pack_callback_data), which keeps every button well under Telegram's 64-byte limit.
+CB_DOWNLOAD = 0 # payload: 12-byte ObjectId of the file document
+CB_FILTER_SELECT = 1 # payload: filter code
+CB_FILTER_VALUE = 2 # payload: filter code + UTF-8 value (no value clears the filter)
+CB_PAGE = 3 # payload: PAGE_PREV / PAGE_NEXT
+CB_CANCEL = 4 # payload: CANCEL_SEARCH / CANCEL_FILTER_SELECTION
+CB_DOWNLOAD_ALL = 5 # no payload: every file on the results page shown in the clicked message
+PAGE_PREV, PAGE_NEXT = b"\x00", b"\x01"
+CANCEL_SEARCH, CANCEL_FILTER_SELECTION = b"\x00", b"\x01"
+CALLBACK_DATA_LIMIT = 64
 
 # Filter types
 SEASON_FILTER = "s"
 EPISODE_FILTER = "e" # Though episode might be too granular for a button filter
 QUALITY_FILTER = "q"
 LANGUAGE_FILTER = "l"
+FILTER_FIELD_MAP = {QUALITY_FILTER: "quality", LANGUAGE_FILTER: "language", SEASON_FILTER: "season"}
+
+# callback_data for the static buttons, encoded once
+_CB_PAGE_PREV = pack_callback_data(CB_PAGE, PAGE_PREV)
+_CB_PAGE_NEXT = pack_callback_data(CB_PAGE, PAGE_NEXT)
+_CB_CLOSE_SEARCH = pack_callback_data(CB_CANCEL, CANCEL_SEARCH)
+_CB_BACK_TO_RESULTS = pack_callback_data(CB_CANCEL, CANCEL_FILTER_SELECTION)
+_CB_DOWNLOAD_ALL = pack_callback_data(CB_DOWNLOAD_ALL)
+_CB_FILTER_SELECT = {code: pack_callback_data(CB_FILTER_SELECT, code.encode()) for code in FILTER_FIELD_MAP}
+
+# Search queries must be at least 3 characters once stripped; shorter chat noise is ignored
+# at the filter level so no handler coroutine is created for it.
+SEARCH_QUERY_REGEX = re.compile(r"\S.+\S", re.DOTALL)
 
 # For storing current search state in context.user_data
 SEARCH_STATE_KEY = "current_search_state"
+PAGE_SIZE = 5 # Search results per page
+# The files shown in each results message, per chat, so "Download all" sends exactly that page to whoever clicks it
+RESULT_PAGES_KEY = "result_pages"
+RESULT_PAGES_PER_CHAT = 50 # Older results messages fall back to "search again"
+MEDIA_GROUP_LIMIT = 10 # Telegram allows 2-10 items per send_media_group call
+
+# Active search filters. Immutable and hashable, so it doubles as part of the results cache key.
+SearchFilters = namedtuple(
+    "SearchFilters", ["series_name", "season", "episode", "quality", "language"], defaults=(None,) * 5
+)
+
+# Hashed, immutable copy of the admin list for O(1) membership checks
+_ADMIN_IDS = frozenset(config.ADMIN_IDS)
+
+# File messages waiting to be indexed; auto_index_file only enqueues, _index_worker tasks do the work
+INDEX_QUEUE_SIZE = 1000 # A full queue makes the (non-blocking) handler wait, not drop files
+INDEX_WORKERS = 4
+INDEX_BATCH_SIZE = db.FILE_WRITE_BATCH_SIZE # Messages a worker takes at once; their writes share one bulk_write
+INDEX_DRAIN_TIMEOUT = 10 # Seconds to spend indexing already-queued files on shutdown
+INDEX_PUT_RETRY_INTERVAL = 1 # How often a handler waiting for queue room checks for shutdown
+_INDEX_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=INDEX_QUEUE_SIZE)
+_INDEX_STOPPING = asyncio.Event() # Set on shutdown; waiting handlers give up instead of blocking Application.stop()
+
+# Pool of pre-shortened verification links so /verify doesn't wait on the shortener API
+SHORTLINK_POOL_SIZE = 32
+SHORTLINK_RETRY_DELAY = 30 # Seconds to back off when the shortener is failing
+SHORTLINK_REFILL_CONCURRENCY = 8 # Shortener API calls made in parallel while refilling
+SHORTLINK_POOL_CHECK_INTERVAL = 1 # Seconds between checks while the pool is full
+_SHORTLINK_POOL = asyncio.Queue(maxsize=SHORTLINK_POOL_SIZE)
+
+# Log channel messages are queued and sent in batches by log_writer
+LOG_QUEUE_SIZE = 1000 # Entries beyond this are dropped rather than blocking handlers
+LOG_BATCH_WINDOW = 2 # Max seconds an entry waits for others to join its batch
+LOG_BATCH_CHARS = 4000 # Send early once a batch reaches this size
+LOG_MIN_SEND_INTERVAL = 1 # Seconds between log channel messages, so error floods can't eat the send budget
+ERROR_DEDUP_WINDOW = 10 # Identical errors within this many seconds are posted to the log channel once
+_RECENT_ERRORS = TTLCache(maxsize=1024, ttl=ERROR_DEDUP_WINDOW)
+TELEGRAM_MESSAGE_LIMIT = 4096
+LOG_ERROR_DETAIL_CHARS = 2000 # Per field of an error report, so the tagged entry fits in one message
+LOG_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=LOG_QUEUE_SIZE)
+
+# Long-running tasks started in post_init; cancelled on shutdown since they never finish on their own
+_BACKGROUND_TASKS: list[asyncio.Task] = []
+
+# --- Static Message Texts (built once at import, HTML formatted) ---
+# Only the user's name varies, filled in with str.format (pass it through html.escape)
+WELCOME_TEMPLATE = (
+    f"Kon'nichiwa, {{first_name}}! {config.NARUTO_EMOJI}\n\n"
+    f"I'm your <b>Auto-Filter Bot</b>, ready to help you find and manage anime files! {config.ONE_PIECE_EMOJI}\n"
+    f"Type /help to see what I can do, or just start searching in a group I'm in! {config.SEARCH_EMOJI}\n\n"
+    f"Use /verify in PM to earn {config.TOKEN_EMOJI} tokens!"
+)
+
+HELP_TEXT_USER = (
+    f"{config.AOT_EMOJI} <b>Bot Commands</b> {config.MHA_EMOJI}\n\n"
+    f"{config.SEARCH_EMOJI} <b>Searching (in groups):</b>\n"
+    f"  - Just type the anime name!\n"
+    f"  - Use filters for season, quality, language.\n\n"
+    f"{config.TOKEN_EMOJI} <b>Tokens &amp; Downloads:</b>\n"
+    f"  <code>/tokens</code> - Check your token balance (PM).\n"
+    f"  <code>/verify</code> - Earn tokens by bypassing a link shortener (PM).\n"
+    f"  <i>(1 file download costs {config.TOKENS_PER_FILE} token)</i>\n\n"
+)
+HELP_TEXT_ADMIN = HELP_TEXT_USER + (
+    f"🛡️ <b>Admin Commands:</b>\n"
+    f"  <code>/index &lt;channel_id&gt;</code> - Manually index the last file from a channel.\n"
+    f"  <i>(Forward messages from a channel to this bot to index them if channel_id is not given)</i>\n"
+    f"  <code>/stats</code> - View bot statistics.\n"
+    f"  <code>/broadcast &lt;message&gt;</code> - Broadcast a message to all users (use with caution!).\n"
+)
+
+STATS_TEMPLATE = (
+    f"{config.MHA_EMOJI} <b>Bot Statistics</b> {config.ONE_PIECE_EMOJI}\n\n"
+    f"{config.FILE_EMOJI} Total Stored Files: <b>{{total_files}}</b>\n"
+    f"👥 Total Users: <b>{{total_users}}</b>\n"
+    f"💾 Used Storage (MongoDB Data): <b>{{used_storage}}</b>\n"
+    # f"📁 Free within MongoDB Allocation (approx): <b>{{internal_free}}</b>\n\n" # This might be confusing
+    f"🚀 Bot is powered by the Will of Fire! {config.NARUTO_EMOJI}"
+)
+
+VERIFY_TEXT = (
+    f"{config.TOKEN_EMOJI} <b>Earn Tokens!</b> {config.AOT_EMOJI}\n\n"
+    f"1. Click the button below to open the link.\n"
+    f"2. <b>Bypass the ads/shortener</b> on the page you're taken to.\n"
+    f"3. Once bypassed successfully, you'll be redirected, and I'll automatically credit your account with <b>{config.TOKENS_PER_VERIFICATION} tokens</b>!\n\n"
+    f"{config.INFO_EMOJI} This link will expire in <b>1 hour</b> or after you complete it.\n\n"
+    f"<b>How to Bypass Guide (Example):</b>\n"
+    f"  - Look for 'Skip Ad', 'Continue', or timer buttons.\n"
+    f"  - Close any pop-ups carefully.\n"
+    f"  - You might need to click a few times.\n"
+    f"  - <i>Be patient, dattebayo!</i> {config.NARUTO_EMOJI}"
+)
+VERIFY_SHORTENER_FAILED_TEXT = f"{config.ERROR_EMOJI} Couldn't create a short link right now. Please try again in a bit! {config.NARUTO_EMOJI}"
+VERIFY_DISABLED_TEXT = (
+    f"{config.ERROR_EMOJI} The link shortener feature is currently disabled by the admin.\n"
+    f"Please contact an admin if you believe this is an error."
+)
+VERIFY_BUTTON_TEXT = f"{config.MHA_EMOJI} Go To Verification Link"
 
 
 # --- Helper Functions for Bot ---
+class ORJSONRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Telegram API responses with orjson instead of the stdlib json module."""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes) -> dict:
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError:
+            # Let PTB handle undecodable bytes and raise its usual TelegramError
+            return HTTPXRequest.parse_json_payload(payload)
+
+async def _send_file(bot, chat_id, file_doc, caption=None):
+    """Sends a stored file with the send method matching its type."""
+    if 'video' in file_doc['file_type']:
+        await bot.send_video(chat_id=chat_id, video=file_doc['file_id'], caption=caption, parse_mode=ParseMode.HTML)
+    elif 'audio' in file_doc['file_type']:
+        await bot.send_audio(chat_id=chat_id, audio=file_doc['file_id'], caption=caption, parse_mode=ParseMode.HTML)
+    else: # Default to document
+        await bot.send_document(chat_id=chat_id, document=file_doc['file_id'], caption=caption, parse_mode=ParseMode.HTML)
+
+def _media_groups(file_docs):
+    """
+    Splits file documents into sendable media groups of (file_doc, InputMedia) pairs.
+    Telegram only allows one kind of media per album, so groups are split by type first.
+    """
+    by_type = {}
+    for file_doc in file_docs:
+        caption = html.escape(file_doc.get('file_name', 'N/A'))
+        if 'video' in file_doc['file_type']:
+            media = InputMediaVideo(media=file_doc['file_id'], caption=caption, parse_mode=ParseMode.HTML)
+        elif 'audio' in file_doc['file_type']:
+            media = InputMediaAudio(media=file_doc['file_id'], caption=caption, parse_mode=ParseMode.HTML)
+        else:
+            media = InputMediaDocument(media=file_doc['file_id'], caption=caption, parse_mode=ParseMode.HTML)
+        by_type.setdefault(type(media), []).append((file_doc, media))
+    return [group[i:i + MEDIA_GROUP_LIMIT] for group in by_type.values() for i in range(0, len(group), MEDIA_GROUP_LIMIT)]
+
+async def _redirect_to_pm(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Deletes a PM-only command from the group and nudges the user in PM, both at once."""
+    results = await asyncio.gather(
+        update.message.delete(),
+        context.bot.send_message(update.effective_user.id, text),
+        return_exceptions=True
+    )
+    for result in results:
+        if isinstance(result, TelegramError):
+            logger.warning(f"Could not delete {update.message.text} message or PM user: {result}")
+        elif isinstance(result, Exception):
+            raise result
+
 def is_admin(user_id: int) -> bool:
-    return user_id in config.ADMIN_IDS
+    return user_id in _ADMIN_IDS
 
-async def log_to_channel(context: ContextTypes.DEFAULT_TYPE, message: str):
+def log_to_channel(context: ContextTypes.DEFAULT_TYPE, message: str):
+    """
+    Queues a message for the log channel; log_writer sends it with the next batch.
+    Not a coroutine: callers never wait on the log channel.
+    """
     if config.LOG_CHANNEL_ID:
         try:
-            await context.bot.send_message(chat_id=config.LOG_CHANNEL_ID, text=message, parse_mode=ParseMode.HTML)
-        except Exception as e:
-            logger.error(f"Failed to log to channel: {e}")
+            LOG_QUEUE.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.warning(f"Log channel queue full, dropping entry: {message[:100]}")
+
+def _pack_log_messages(messages: list[str]) -> list[tuple[str, str]]:
+    """
+    Joins log entries into as few texts as possible, each within Telegram's message limit.
+    Returns (text, parse_mode) pairs. Slicing HTML would leave broken tags, so an oversized
+    entry is split and sent as plain text instead.
+    """
+    packed = []
+    current = ""
+    for message in messages:
+        if len(message) > TELEGRAM_MESSAGE_LIMIT:
+            if current: # Keep entries in order
+                packed.append((current, ParseMode.HTML))
+                current = ""
+            for i in range(0, len(message), TELEGRAM_MESSAGE_LIMIT):
+                packed.append((message[i:i + TELEGRAM_MESSAGE_LIMIT], None))
+            continue
+        if current and len(current) + 2 + len(message) > TELEGRAM_MESSAGE_LIMIT:
+            packed.append((current, ParseMode.HTML))
+            current = ""
+        current = f"{current}\n\n{message}" if current else message
+    if current:
+        packed.append((current, ParseMode.HTML))
+    return packed
+
+def _escape_truncated(text: str, limit: int) -> str:
+    """HTML-escapes text and cuts it to at most limit characters without splitting an entity."""
+    escaped = html.escape(text)
+    if len(escaped) <= limit:
+        return escaped
+    escaped = escaped[:limit - 1]
+    amp = escaped.rfind("&")
+    if amp != -1 and ";" not in escaped[amp:]: # Don't leave half of an &amp; behind
+        escaped = escaped[:amp]
+    return escaped + "…"
+
+async def log_writer(bot):
+    """Background task that drains LOG_QUEUE, sending entries to the log channel in batches."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await LOG_QUEUE.get()]
+        batch_chars = len(batch[0])
+        deadline = loop.time() + LOG_BATCH_WINDOW
+        while batch_chars < LOG_BATCH_CHARS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(LOG_QUEUE.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(message)
+            batch_chars += len(message)
+        for text, parse_mode in _pack_log_messages(batch):
+            try:
+                await bot.send_message(chat_id=config.LOG_CHANNEL_ID, text=text, parse_mode=parse_mode)
+            except Exception as e:
+                logger.error(f"Failed to log to channel: {e}")
+            await asyncio.sleep(LOG_MIN_SEND_INTERVAL)
+
+async def create_verification_link():
+    """Generates a new verification token and its (shortened) callback link."""
+    verification_token = generate_verification_token()
+    target_url = get_verification_callback_url(verification_token)
+    short_link = await shorten_link(target_url)
+    return verification_token, target_url, short_link
+
+async def shortlink_pool_filler():
+    """Background task that keeps _SHORTLINK_POOL topped up, shortening missing links in parallel."""
+    while True:
+        missing = SHORTLINK_POOL_SIZE - _SHORTLINK_POOL.qsize()
+        if missing <= 0:
+            await asyncio.sleep(SHORTLINK_POOL_CHECK_INTERVAL)
+            continue
+
+        batch_size = min(missing, SHORTLINK_REFILL_CONCURRENCY)
+        entries = await asyncio.gather(
+            *(create_verification_link() for _ in range(batch_size)), return_exceptions=True
+        )
+        pooled = 0
+        for entry in entries:
+            if isinstance(entry, Exception):
+                logger.error(f"Failed to pre-generate verification link: {entry}")
+                continue
+            _, target_url, short_link = entry
+            if short_link == target_url: # Shortener failed, don't pool unshortened links
+                continue
+            _SHORTLINK_POOL.put_nowait(entry) # Only this task adds to the pool, so there is room
+            pooled += 1
+        if pooled < batch_size: # Shortener is struggling, back off
+            await asyncio.sleep(SHORTLINK_RETRY_DELAY)
 
 # --- Command Handlers ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    await db.get_or_create_user(user.id, user.username, user.first_name)
-    welcome_message = (
-        f"Kon'nichiwa, {user.first_name}! {config.NARUTO_EMOJI}\n\n"
-        f"I'm your **Auto-Filter Bot**, ready to help you find and manage anime files! {config.ONE_PIECE_EMOJI}\n"
-        f"Type /help to see what I can do, or just start searching in a group I'm in! {config.SEARCH_EMOJI}\n\n"
-        f"Use /verify in PM to earn {config.TOKEN_EMOJI} tokens!"
-    )
-    await update.message.reply_text(welcome_message, parse_mode=ParseMode.MARKDOWN)
+    # Registration result isn't needed for the reply, so don't wait on it
+    context.application.create_task(db.ensure_user(user.id, user.username, user.first_name), update=update)
+    welcome_message = WELCOME_TEMPLATE.format(first_name=html.escape(user.first_name))
+    await update.message.reply_text(welcome_message, parse_mode=ParseMode.HTML)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    help_text = (
-        f"{config.AOT_EMOJI} **Bot Commands** {config.MHA_EMOJI}\n\n"
-        f"{config.SEARCH_EMOJI} **Searching (in groups):**\n"
-        f"  - Just type the anime name!\n"
-        f"  - Use filters for season, quality, language.\n\n"
-        f"{config.TOKEN_EMOJI} **Tokens & Downloads:**\n"
-        f"  `/tokens` - Check your token balance (PM).\n"
-        f"  `/verify` - Earn tokens by bypassing a link shortener (PM).\n"
-        f"  *(1 file download costs {config.TOKENS_PER_FILE} token)*\n\n"
-    )
-    if is_admin(update.effective_user.id):
-        help_text += (
-            f"🛡️ **Admin Commands:**\n"
-            f"  `/index <channel_id>` - Manually index the last file from a channel.\n"
-            f"  *(Forward messages from a channel to this bot to index them if channel_id is not given)*\n"
-            f"  `/stats` - View bot statistics.\n"
-            f"  `/broadcast <message>` - Broadcast a message to all users (use with caution!).\n"
-        )
-    await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+    help_text = HELP_TEXT_ADMIN if is_admin(update.effective_user.id) else HELP_TEXT_USER
+    await update.message.reply_text(help_text, parse_mode=ParseMode.HTML)
 
 async def index_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update.effective_user.id):
@@ -147,15 +401,16 @@ async def index_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
         if await db.add_file(file_data):
             await update.message.reply_text(f"{config.SUCCESS_EMOJI} File '{file_name}' from channel {actual_channel_id} indexed successfully! {config.AOT_EMOJI}")
-            await log_to_channel(context, f"<b>Manual Index:</b> Admin {update.effective_user.id} indexed {file_name} from channel {actual_channel_id}")
+            log_to_channel(context, f"<b>Manual Index:</b> Admin {update.effective_user.id} indexed {html.escape(file_name)} from channel {actual_channel_id}")
         else:
             await update.message.reply_text(f"{config.INFO_EMOJI} File '{file_name}' already exists in the database.")
     else:
         await update.message.reply_text(
             f"{config.INFO_EMOJI} To manually index:\n"
-            f"1. Use `/index <channel_id>` (this is hard to get specific file).\n"
-            f"2. OR, forward the file message(s) from any channel to me, then reply to one of them with `/index`.\n"
-            f"3. OR, simply forward the file message(s) from *the target channel* to me. I will auto-detect its origin."
+            f"1. Use <code>/index &lt;channel_id&gt;</code> (this is hard to get specific file).\n"
+            f"2. OR, forward the file message(s) from any channel to me, then reply to one of them with <code>/index</code>.\n"
+            f"3. OR, simply forward the file message(s) from <i>the target channel</i> to me. I will auto-detect its origin.",
+            parse_mode=ParseMode.HTML
         )
 
 
@@ -164,11 +419,20 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         await update.message.reply_text(f"{config.ERROR_EMOJI} This jutsu is for admins only!")
         return
 
-    total_files = await db.count_total_files()
-    total_users = await db.count_total_users()
-    
+    # Independent lookups, so issue them together rather than one RTT after another
+    total_files, total_users, db_stats_mongo = await asyncio.gather(
+        db.count_total_files(), db.count_total_users(), db.get_db_stats(), return_exceptions=True
+    )
+    if isinstance(total_files, Exception):
+        logger.error(f"Error counting files: {total_files}")
+        total_files = "N/A"
+    if isinstance(total_users, Exception):
+        logger.error(f"Error counting users: {total_users}")
+        total_users = "N/A"
+
     try:
-        db_stats_mongo = await db.get_db_stats()
+        if isinstance(db_stats_mongo, Exception):
+            raise db_stats_mongo
         # dataSize is typically the most relevant for "used storage by documents"
         used_storage_bytes = db_stats_mongo.get("dataSize", 0) 
         # storageSize is allocated storage, often larger than dataSize due to preallocation/padding
@@ -186,53 +450,39 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         used_storage_hr = "N/A"
         internal_free_hr = "N/A"
 
-    stats_message = (
-        f"{config.MHA_EMOJI} **Bot Statistics** {config.ONE_PIECE_EMOJI}\n\n"
-        f"{config.FILE_EMOJI} Total Stored Files: **{total_files}**\n"
-        f"👥 Total Users: **{total_users}**\n"
-        f"💾 Used Storage (MongoDB Data): **{used_storage_hr}**\n"
-        # f"📁 Free within MongoDB Allocation (approx): **{internal_free_hr}**\n\n" # This might be confusing
-        f"🚀 Bot is powered by the Will of Fire! {config.NARUTO_EMOJI}"
+    stats_message = STATS_TEMPLATE.format(
+        total_files=total_files, total_users=total_users, used_storage=used_storage_hr
     )
-    await update.message.reply_text(stats_message, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(stats_message, parse_mode=ParseMode.HTML)
 
 async def tokens_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    await db.get_or_create_user(user.id, user.username, user.first_name) # Ensure user exists
+    token_balance = await db.get_user_tokens(user.id, user.username, user.first_name) # Also ensures user exists
     
     # Ensure command is used in PM
     if update.message.chat.type != ChatType.PRIVATE:
-        try:
-            await update.message.delete() # Delete command from group
-            await context.bot.send_message(
-                user.id,
-                f"{config.INFO_EMOJI} Yo, {user.first_name}! Please use /tokens and /verify in our private chat, okay? Keeps the group tidy! {config.NARUTO_EMOJI}"
-            )
-        except TelegramError as e:
-            logger.warning(f"Could not delete /tokens message or PM user: {e}")
+        await _redirect_to_pm(
+            update, context,
+            f"{config.INFO_EMOJI} Yo, {user.first_name}! Please use /tokens and /verify in our private chat, okay? Keeps the group tidy! {config.NARUTO_EMOJI}"
+        )
         return
 
-    token_balance = await db.get_user_tokens(user.id)
     message = (
-        f"Hey {user.first_name}! {config.ONE_PIECE_EMOJI}\n"
-        f"You currently have **{token_balance} {config.TOKEN_EMOJI} tokens**.\n\n"
+        f"Hey {html.escape(user.first_name)}! {config.ONE_PIECE_EMOJI}\n"
+        f"You currently have <b>{token_balance} {config.TOKEN_EMOJI} tokens</b>.\n\n"
         f"Need more? Use /verify to earn tokens! {config.AOT_EMOJI}"
     )
-    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(message, parse_mode=ParseMode.HTML)
 
 async def verify_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
-    await db.get_or_create_user(user.id, user.username, user.first_name)
+    context.application.create_task(db.ensure_user(user.id, user.username, user.first_name), update=update)
 
     if update.message.chat.type != ChatType.PRIVATE:
-        try:
-            await update.message.delete()
-            await context.bot.send_message(
-                user.id,
-                f"{config.INFO_EMOJI} Hey {user.first_name}! Let's handle the /verify process in our PM. It's more secure! {config.MHA_EMOJI}"
-            )
-        except TelegramError as e:
-            logger.warning(f"Could not delete /verify message or PM user: {e}")
+        await _redirect_to_pm(
+            update, context,
+            f"{config.INFO_EMOJI} Hey {user.first_name}! Let's handle the /verify process in our PM. It's more secure! {config.MHA_EMOJI}"
+        )
         return
 
     # Check if APP_BASE_URL is configured
@@ -243,38 +493,23 @@ async def verify_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error("APP_BASE_URL not configured. /verify command cannot proceed.")
         return
 
-    verification_token = generate_verification_token()
+    try:
+        verification_token, target_url_for_shortener, short_link = _SHORTLINK_POOL.get_nowait()
+    except asyncio.QueueEmpty: # Pool drained (or shortener disabled), shorten inline
+        verification_token, target_url_for_shortener, short_link = await create_verification_link()
     await db.add_pending_verification(user.id, verification_token)
-    
-    target_url_for_shortener = get_verification_callback_url(verification_token)
-    short_link = await shorten_link(target_url_for_shortener)
 
     if short_link == target_url_for_shortener and config.MODIJI_API_KEY: # Shortening failed or disabled but API key was present
-        message_text = f"{config.ERROR_EMOJI} Couldn't create a short link right now. Please try again in a bit! {config.NARUTO_EMOJI}"
+        message_text = VERIFY_SHORTENER_FAILED_TEXT
     elif short_link == target_url_for_shortener and not config.MODIJI_API_KEY: # Shortening disabled
-         message_text = (
-            f"{config.ERROR_EMOJI} The link shortener feature is currently disabled by the admin.\n"
-            f"Please contact an admin if you believe this is an error."
-         )
-         await update.message.reply_text(message_text)
+         await update.message.reply_text(VERIFY_DISABLED_TEXT)
          return
     else:
-        message_text = (
-            f"{config.TOKEN_EMOJI} **Earn Tokens!** {config.AOT_EMOJI}\n\n"
-            f"1. Click the button below to open the link.\n"
-            f"2. **Bypass the ads/shortener** on the page you're taken to.\n"
-            f"3. Once bypassed successfully, you'll be redirected, and I'll automatically credit your account with **{config.TOKENS_PER_VERIFICATION} tokens**!\n\n"
-            f"{config.INFO_EMOJI} This link will expire in **1 hour** or after you complete it.\n\n"
-            f"**How to Bypass Guide (Example):**\n"
-            f"  - Look for 'Skip Ad', 'Continue', or timer buttons.\n"
-            f"  - Close any pop-ups carefully.\n"
-            f"  - You might need to click a few times.\n"
-            f"  - *Be patient, dattebayo!* {config.NARUTO_EMOJI}"
-        )
+        message_text = VERIFY_TEXT
 
-    keyboard = [[InlineKeyboardButton(f"{config.MHA_EMOJI} Go To Verification Link", url=short_link)]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+    # Only the URL changes per call; the button label is a prebuilt constant
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(VERIFY_BUTTON_TEXT, url=short_link)]])
+    await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
 # --- Message Handlers (Auto Indexing & Search) ---
@@ -282,7 +517,66 @@ async def verify_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def auto_index_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles files uploaded/forwarded to the DB_CHANNEL_ID or direct forwards to bot by admin."""
     message = update.effective_message
-    
+    # Always try to enqueue: updates handled during Application.stop() still reach the live workers
+    try:
+        _INDEX_QUEUE.put_nowait((message, context))
+        return
+    except asyncio.QueueFull:
+        pass
+    while not _INDEX_STOPPING.is_set():
+        try: # Wait for room, but wake up regularly to notice a shutdown
+            await asyncio.wait_for(_INDEX_QUEUE.put((message, context)), INDEX_PUT_RETRY_INTERVAL)
+            return
+        except asyncio.TimeoutError:
+            pass
+    logger.warning(f"Shutting down, not indexing message {message.message_id} from chat {message.chat.id}.")
+
+async def _report_index_failure(message, context: ContextTypes.DEFAULT_TYPE, error: Exception, file_name: str = None) -> None:
+    """Reports a file that couldn't be indexed to the log channel, and to the admin if they forwarded it."""
+    logger.error(f"Error indexing {file_name or 'message ' + str(message.message_id)} from chat {message.chat.id}: {error}", exc_info=error)
+    log_to_channel(context, f"<b>Auto-Index Failed:</b> {html.escape(file_name or 'message ' + str(message.message_id))} from chat {message.chat.id}\n<code>{html.escape(str(error))}</code>")
+    if message.chat.type == ChatType.PRIVATE: # Only admin forwards reach the bot in PM
+        try:
+            await message.reply_text(f"{config.ERROR_EMOJI} Couldn't index '{file_name or 'this file'}' due to an error. Please try again later. ({error})", quote=True)
+        except TelegramError as e:
+            logger.warning(f"Could not tell admin about failed index: {e}")
+
+async def _index_worker():
+    """Background task that indexes queued messages, a batch at a time."""
+    while True:
+        batch = [await _INDEX_QUEUE.get()]
+        while len(batch) < INDEX_BATCH_SIZE and not _INDEX_QUEUE.empty():
+            batch.append(_INDEX_QUEUE.get_nowait())
+        try:
+            prepared = [] # (message, context, file_data, is_admin_forward)
+            reports = []
+            for message, context in batch:
+                try:
+                    entry = _file_data_from_message(message)
+                except Exception as e:
+                    reports.append(_report_index_failure(message, context, e))
+                    continue
+                if entry:
+                    prepared.append((message, context, *entry))
+            # One call for the whole batch, so it goes out in a single bulk_write
+            results = await db.add_files_bulk([file_data for _, _, file_data, _ in prepared]) if prepared else []
+            for (message, context, file_data, is_admin_forward), result in zip(prepared, results):
+                if isinstance(result, Exception):
+                    reports.append(_report_index_failure(message, context, result, file_data["file_name"]))
+                else:
+                    reports.append(_report_indexed(message, context, file_data, result, is_admin_forward))
+            for report in await asyncio.gather(*reports, return_exceptions=True):
+                if isinstance(report, Exception):
+                    logger.error(f"Error reporting indexed file: {report}")
+        finally:
+            for _ in batch:
+                _INDEX_QUEUE.task_done()
+
+def _file_data_from_message(message):
+    """
+    Builds the file document for a channel/forwarded message that carries a file.
+    Returns (file_data, is_admin_forward), or None if the message isn't one to index.
+    """
     # Case 1: Message in the configured DB_CHANNEL_ID
     is_db_channel_message = message.chat.id == config.DB_CHANNEL_ID
 
@@ -295,11 +589,9 @@ async def auto_index_file(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
 
     if not (is_db_channel_message or is_admin_forward):
-        return # Not a relevant message for auto-indexing
+        return None # Not a relevant message for auto-indexing
 
-    file_entity = message.document or message.video or message.audio
-    if not file_entity:
-        return
+    file_entity = message.document or message.video or message.audio # Handler filters guarantee one is set
 
     file_id = file_entity.file_id
     file_name = getattr(file_entity, 'file_name', f"Unnamed_{file_id[:8]}")
@@ -313,14 +605,9 @@ async def auto_index_file(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     metadata = parse_filename(file_name)
     if not metadata.get("series_name") and caption: # Try parsing caption if filename didn't yield series
+        # Caption fills in whatever the filename didn't provide (including the series name)
         caption_metadata = parse_filename(caption)
-        if caption_metadata.get("series_name"): # Prioritize caption's series name if found
-            metadata["series_name"] = caption_metadata["series_name"]
-        # Merge other fields if filename didn't provide them
-        for key in ["season", "episode", "quality", "language"]:
-            if not metadata.get(key) and caption_metadata.get(key):
-                metadata[key] = caption_metadata[key]
-
+        metadata = {**caption_metadata, **{k: v for k, v in metadata.items() if v}}
 
     file_data = {
         "file_id": file_id,
@@ -336,16 +623,20 @@ async def auto_index_file(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         "quality": metadata.get("quality"),
         "language": metadata.get("language"),
     }
-
-    if await db.add_file(file_data):
-        log_msg = (f"<b>Auto-Indexed File:</b> {file_name}\n"
-                   f"Series: {metadata.get('series_name')}, S{metadata.get('season')}E{metadata.get('episode')}\n"
-                   f"Quality: {metadata.get('quality')}, Lang: {metadata.get('language')}\n"
-                   f"From Channel: {original_channel_id}")
+    return file_data, is_admin_forward
+
+async def _report_indexed(message, context: ContextTypes.DEFAULT_TYPE, file_data: dict, is_new: bool, is_admin_forward: bool) -> None:
+    """Logs an auto-index result and confirms it to the admin who forwarded the file."""
+    file_name = file_data["file_name"]
+    if is_new:
+        log_msg = (f"<b>Auto-Indexed File:</b> {html.escape(file_name)}\n"
+                   f"Series: {html.escape(str(file_data['series_name']))}, S{file_data['season']}E{file_data['episode']}\n"
+                   f"Quality: {html.escape(str(file_data['quality']))}, Lang: {html.escape(str(file_data['language']))}\n"
+                   f"From Channel: {file_data['channel_id']}")
         logger.info(f"Auto-indexed: {file_name}")
         if is_admin_forward: # If admin forwarded, confirm to admin
             await message.reply_text(f"{config.SUCCESS_EMOJI} File '{file_name}' auto-indexed from forwarded message!", quote=True)
-        await log_to_channel(context, log_msg)
+        log_to_channel(context, log_msg)
     else:
         logger.info(f"Duplicate file (auto-index attempt): {file_name}")
         # Optionally notify admin if it's a direct forward and was a duplicate
@@ -354,22 +645,12 @@ async def auto_index_file(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handles text messages in groups for searching files."""
-    if not update.message or not update.message.text or update.message.chat.type == ChatType.PRIVATE:
-        # Only process text messages in groups/supergroups, ignore commands
-        if update.message and update.message.text and update.message.text.startswith('/'):
-            return
-        return
-
+    """Handles text messages in groups for searching files. Message type filtering happens at registration."""
     query = update.message.text.strip()
-    if len(query) < 3: # Minimum query length
-        # await update.message.reply_text(f"{config.INFO_EMOJI} Search query too short! Enter at least 3 characters.", quote=True)
-        return # Don't respond to very short messages to avoid spam
-
     # Initialize search state
     search_state = {
         "query": query,
-        "filters": {"series_name": None, "season": None, "episode": None, "quality": None, "language": None}, # episode filter might be too much for buttons
+        "filters": SearchFilters(), # episode filter might be too much for buttons
         "page": 1
     }
     context.user_data[SEARCH_STATE_KEY] = search_state
@@ -377,23 +658,44 @@ async def search_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await display_search_results(update, context, search_state, is_new_search=True)
 
 
+def _remember_results_page(context: ContextTypes.DEFAULT_TYPE, message_id: int, results: list):
+    """Records which files a results message shows, for its "Download all" button."""
+    pages = context.chat_data.get(RESULT_PAGES_KEY)
+    if pages is None:
+        pages = context.chat_data[RESULT_PAGES_KEY] = LRUCache(maxsize=RESULT_PAGES_PER_CHAT)
+    pages[message_id] = results
+
 async def display_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, search_state: dict, is_new_search: bool = False):
     """Displays search results with filter buttons and pagination."""
     query = search_state["query"]
-    filters_dict = search_state["filters"] # Renamed to avoid conflict with imported 'filters' module
+    search_filters = search_state["filters"]
+    filters_dict = search_filters._asdict() # Named to avoid conflict with imported 'filters' module
+    has_filters = any(search_filters)
     page = search_state["page"]
 
-    results, total_files = await db.find_files(query, filters_dict, page, page_size=5) # Display 5 results per page
+    # Filters can't narrow down a single page of results, so only look up options when there's more.
+    # Active filters keep their buttons, otherwise they could never be cleared.
+    if has_filters: # Options are needed regardless of the count, so fetch them alongside the results
+        (results, total_files), distinct_values = await asyncio.gather(
+            db.find_files(query, filters_dict, page, page_size=PAGE_SIZE),
+            db.get_distinct_values_multi(("quality", "language", "season"), query, filters_dict)
+        )
+    else:
+        results, total_files = await db.find_files(query, filters_dict, page, page_size=PAGE_SIZE)
+        if total_files > PAGE_SIZE:
+            distinct_values = await db.get_distinct_values_multi(("quality", "language", "season"), query, filters_dict)
+        else:
+            distinct_values = {"quality": [], "language": [], "season": []}
 
     if not results and page == 1: # No results at all for this query/filter
-        message_text = f"{config.NARUTO_EMOJI} No files found for '`{query}`'"
-        if any(filters_dict.values()):
-            message_text += " with the current filters_dict."
-        message_text += f"\nTry a different search term or adjust filters_dict! {config.ONE_PIECE_EMOJI}"
+        message_text = f"{config.NARUTO_EMOJI} No files found for '<code>{html.escape(query)}</code>'"
+        if has_filters:
+            message_text += " with the current filters."
+        message_text += f"\nTry a different search term or adjust filters! {config.ONE_PIECE_EMOJI}"
         if is_new_search and update.message:
-            await update.message.reply_text(message_text, parse_mode=ParseMode.MARKDOWN, quote=True)
+            await update.message.reply_text(message_text, parse_mode=ParseMode.HTML, quote=True)
         elif update.callback_query: # Editing a message from callback
-            await update.callback_query.edit_message_text(message_text, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
+            await update.callback_query.edit_message_text(message_text, parse_mode=ParseMode.HTML, reply_markup=None)
         return
 
     if not results and page > 1: # No more results on this page (e.g., user clicked "Next" on last page)
@@ -404,10 +706,10 @@ async def display_search_results(update: Update, context: ContextTypes.DEFAULT_T
 
 
     # --- Build Results Message ---
-    results_text = f"{config.SEARCH_EMOJI} Search Results for '`{query}`':\n"
-    if any(filters_dict.values()):
-        active_filters_dict = ", ".join([f"{k.title()}: {v}" for k,v in filters_dict.items() if v])
-        results_text += f"Filters: _{active_filters_dict}_\n"
+    results_text = f"{config.SEARCH_EMOJI} Search Results for '<code>{html.escape(query)}</code>':\n"
+    if has_filters:
+        active_filters = ", ".join([f"{k.title()}: {html.escape(str(v))}" for k,v in filters_dict.items() if v])
+        results_text += f"Filters: <i>{active_filters}</i>\n"
     results_text += "\n"
 
     # --- Build Inline Keyboard ---
@@ -415,29 +717,29 @@ async def display_search_results(update: Update, context: ContextTypes.DEFAULT_T
 
     # Filter Buttons (Top Row)
     filter_buttons = []
-    # Get available distinct values based on current query AND other active filters_dict
-    
+    # Available distinct values (fetched above) are based on current query AND other active filters_dict
+
     # Quality
-    qualities = await db.get_distinct_values("quality", query, {k:v for k,v in filters_dict.items() if k != "quality"})
+    qualities = distinct_values["quality"]
     if qualities:
         current_q = filters_dict.get("quality","All Q")
         q_text = f"📺 {current_q}" if filters_dict.get("quality") else "📺 Quality"
-        filter_buttons.append(InlineKeyboardButton(q_text, callback_data=f"{FILTER_PREFIX}{QUALITY_FILTER}_select"))
+        filter_buttons.append(InlineKeyboardButton(q_text, callback_data=_CB_FILTER_SELECT[QUALITY_FILTER]))
     
     # Language
-    languages = await db.get_distinct_values("language", query, {k:v for k,v in filters_dict.items() if k != "language"})
+    languages = distinct_values["language"]
     if languages:
         current_l = filters_dict.get("language","All L")
         l_text = f"🏳️ {current_l}" if filters_dict.get("language") else "🏳️ Language"
-        filter_buttons.append(InlineKeyboardButton(l_text, callback_data=f"{FILTER_PREFIX}{LANGUAGE_FILTER}_select"))
+        filter_buttons.append(InlineKeyboardButton(l_text, callback_data=_CB_FILTER_SELECT[LANGUAGE_FILTER]))
     
     # Season (if series is somewhat specific)
     # Only show season filter if a series seems to be narrowed down or if results have season info
-    seasons = await db.get_distinct_values("season", query, {k:v for k,v in filters_dict.items() if k != "season"})
+    seasons = distinct_values["season"]
     if seasons: # Only show if there are seasons to filter by
         current_s = f"S{filters_dict.get('season')}" if filters_dict.get('season') else "All S"
         s_text = f"🌊 {current_s}" if filters_dict.get('season') else "🌊 Season"
-        filter_buttons.append(InlineKeyboardButton(s_text, callback_data=f"{FILTER_PREFIX}{SEASON_FILTER}_select"))
+        filter_buttons.append(InlineKeyboardButton(s_text, callback_data=_CB_FILTER_SELECT[SEASON_FILTER]))
 
     if filter_buttons:
         keyboard.append(filter_buttons)
@@ -447,31 +749,38 @@ async def display_search_results(update: Update, context: ContextTypes.DEFAULT_T
         file_name = file_doc.get('file_name', 'Unknown File')
         
         button_text = f"{config.FILE_EMOJI} {file_name[:50]}{'...' if len(file_name)>50 else ''}" # Truncate long names
-        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"{DOWNLOAD_PREFIX}{file_doc['file_id']}")])
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=pack_callback_data(CB_DOWNLOAD, file_doc['_id'].binary))])
+
+    if len(results) > 1:
+        page_cost = len(results) * config.TOKENS_PER_FILE
+        keyboard.append([InlineKeyboardButton(f"📥 Download all {len(results)} ({page_cost} {config.TOKEN_EMOJI})", callback_data=_CB_DOWNLOAD_ALL)])
 
     # Pagination Buttons
-    total_pages = (total_files + 4) // 5 # 5 items per page
+    total_pages = -(-total_files // PAGE_SIZE)
+    search_state["total_pages"] = total_pages # Lets pagination clicks past either end skip the re-render
     pagination_buttons = []
     if page > 1:
-        pagination_buttons.append(InlineKeyboardButton(f"« Previous {config.AOT_EMOJI}", callback_data=f"{PAGE_PREFIX}prev"))
+        pagination_buttons.append(InlineKeyboardButton(f"« Previous {config.AOT_EMOJI}", callback_data=_CB_PAGE_PREV))
     if page < total_pages:
-        pagination_buttons.append(InlineKeyboardButton(f"Next {config.MHA_EMOJI} »", callback_data=f"{PAGE_PREFIX}next"))
+        pagination_buttons.append(InlineKeyboardButton(f"Next {config.MHA_EMOJI} »", callback_data=_CB_PAGE_NEXT))
     
     if pagination_buttons:
         keyboard.append(pagination_buttons)
     
     # Cancel button
-    keyboard.append([InlineKeyboardButton(f"{config.ERROR_EMOJI} Close Search", callback_data=f"{CANCEL_PREFIX}search")])
+    keyboard.append([InlineKeyboardButton(f"{config.ERROR_EMOJI} Close Search", callback_data=_CB_CLOSE_SEARCH)])
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     full_message = f"{results_text}Page {page}/{total_pages} ({total_files} total matches)"
 
     if is_new_search and update.message: # New search initiated by a text message
-        await update.message.reply_text(full_message, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN, quote=True)
+        sent = await update.message.reply_text(full_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML, quote=True)
+        _remember_results_page(context, sent.message_id, results)
     elif update.callback_query: # Editing an existing message due to pagination or filter change
+        _remember_results_page(context, update.callback_query.message.message_id, results)
         try:
-            await update.callback_query.edit_message_text(full_message, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+            await update.callback_query.edit_message_text(full_message, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         except TelegramError as e:
             if "Message is not modified" in str(e):
                 await update.callback_query.answer("No changes to display.", show_alert=False)
@@ -487,47 +796,52 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
     await query.answer() # Acknowledge callback
 
     user_id = query.from_user.id
-    data = query.data
+    callback = unpack_callback_data(query.data)
+    if not callback:
+        return # Unknown/outdated button
+    action, payload = callback
 
     search_state = context.user_data.get(SEARCH_STATE_KEY)
-    if not search_state and not data.startswith(DOWNLOAD_PREFIX) and not data.startswith(CANCEL_PREFIX): # Need state for most operations
+    if not search_state and action not in (CB_DOWNLOAD, CB_DOWNLOAD_ALL, CB_CANCEL): # Need state for most operations
         await query.edit_message_text(f"{config.ERROR_EMOJI} Search session expired or invalid. Please start a new search.")
         return
 
     # --- Download Action ---
-    if data.startswith(DOWNLOAD_PREFIX):
-        file_id_to_download = data.split(DOWNLOAD_PREFIX)[1]
-        user_tokens = await db.get_user_tokens(user_id)
+    if action == CB_DOWNLOAD:
+        try:
+            file_object_id = ObjectId(payload)
+        except (InvalidId, TypeError): # bytes that aren't 12 long raise TypeError
+            return
+        # Atomic balance check + debit (no double-spend on parallel clicks), alongside the file lookup
+        tokens_left, file_doc = await asyncio.gather(
+            db.try_debit_tokens(user_id, config.TOKENS_PER_FILE),
+            db.get_file_by_object_id(file_object_id)
+        )
 
-        if user_tokens >= config.TOKENS_PER_FILE:
-            await db.update_user_tokens(user_id, -config.TOKENS_PER_FILE)
-            file_doc = await db.get_file_by_id(file_id_to_download)
+        if tokens_left is not None:
             if file_doc:
                 try:
                     caption = (
-                        f"{config.NARUTO_EMOJI} Here's your file: **{file_doc.get('file_name', 'N/A')}**\n"
-                        f"Series: {file_doc.get('series_name', 'N/A')}\n"
+                        f"{config.NARUTO_EMOJI} Here's your file: <b>{html.escape(file_doc.get('file_name', 'N/A'))}</b>\n"
+                        f"Series: {html.escape(str(file_doc.get('series_name', 'N/A')))}\n"
                         f"S{file_doc.get('season', 'N/A')}E{file_doc.get('episode', 'N/A')}\n"
-                        f"Quality: {file_doc.get('quality', 'N/A')}, Lang: {file_doc.get('language', 'N/A')}\n\n"
+                        f"Quality: {html.escape(str(file_doc.get('quality', 'N/A')))}, Lang: {html.escape(str(file_doc.get('language', 'N/A')))}\n\n"
                         f"Thanks for using the bot! {config.ONE_PIECE_EMOJI}"
                     )
-                    if 'video' in file_doc['file_type']:
-                         await context.bot.send_video(chat_id=user_id, video=file_doc['file_id'], caption=caption, parse_mode=ParseMode.MARKDOWN)
-                    elif 'audio' in file_doc['file_type']:
-                         await context.bot.send_audio(chat_id=user_id, audio=file_doc['file_id'], caption=caption, parse_mode=ParseMode.MARKDOWN)
-                    else: # Default to document
-                         await context.bot.send_document(chat_id=user_id, document=file_doc['file_id'], caption=caption, parse_mode=ParseMode.MARKDOWN)
-                    
+                    await _send_file(context.bot, user_id, file_doc, caption)
+
                     await query.message.reply_text(f"{config.SUCCESS_EMOJI} File sent to your PM! Check your chat with me. ({config.TOKENS_PER_FILE} {config.TOKEN_EMOJI} token deducted)")
-                    await log_to_channel(context, f"User {user_id} downloaded {file_doc.get('file_name', 'N/A')}. Tokens left: {user_tokens - config.TOKENS_PER_FILE}")
+                    log_to_channel(context, f"User {user_id} downloaded {html.escape(file_doc.get('file_name', 'N/A'))}. Tokens left: {tokens_left}")
 
                 except TelegramError as e:
-                    logger.error(f"Error sending file {file_id_to_download} to {user_id}: {e}")
+                    logger.error(f"Error sending file {file_doc['file_id']} to {user_id}: {e}")
                     await context.bot.send_message(user_id, f"{config.ERROR_EMOJI} Couldn't send the file due to an error. Your token has not been deducted. Please try again or contact admin. ({e})")
                     await db.update_user_tokens(user_id, config.TOKENS_PER_FILE) # Refund token
             else:
+                await db.update_user_tokens(user_id, config.TOKENS_PER_FILE) # Refund token, nothing was sent
                 await context.bot.send_message(user_id, f"{config.ERROR_EMOJI} File not found in database. It might have been removed.")
         else:
+            user_tokens = await db.get_user_tokens(user_id)
             await context.bot.send_message(
                 user_id,
                 f"{config.ERROR_EMOJI} Not enough tokens! {config.MHA_EMOJI}\n"
@@ -540,17 +854,54 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
                 pass 
         return 
 
-    # --- Filter Selection Trigger ---
-    if data.startswith(FILTER_PREFIX) and data.endswith("_select"):
-        filter_type_code = data.split(FILTER_PREFIX)[1].split("_select")[0]
-        
-        field_map = {QUALITY_FILTER: "quality", LANGUAGE_FILTER: "language", SEASON_FILTER: "season"}
-        db_field = field_map.get(filter_type_code)
+    # --- Download All Action (current page) ---
+    if action == CB_DOWNLOAD_ALL:
+        # The page belongs to the message, not to the clicker's own search state
+        file_docs = context.chat_data.get(RESULT_PAGES_KEY, {}).get(query.message.message_id)
+        if not file_docs: # Too old, or the bot restarted since it was shown
+            await context.bot.send_message(user_id, f"{config.ERROR_EMOJI} That results page has expired. Please search again and use the new buttons!")
+            return
+        cost = len(file_docs) * config.TOKENS_PER_FILE
+        tokens_left = await db.try_debit_tokens(user_id, cost) # Whole page or nothing
+        if tokens_left is None:
+            user_tokens = await db.get_user_tokens(user_id)
+            await context.bot.send_message(
+                user_id,
+                f"{config.ERROR_EMOJI} Not enough tokens! {config.MHA_EMOJI}\n"
+                f"You need {cost} {config.TOKEN_EMOJI} to download all {len(file_docs)} files, but you only have {user_tokens}.\n"
+                f"Use /verify in PM to earn more tokens!"
+            )
+            return
 
-        if not db_field: return 
+        sent = 0
+        for group in _media_groups(file_docs):
+            try:
+                if len(group) == 1: # Albums need at least 2 items
+                    await _send_file(context.bot, user_id, group[0][0], group[0][1].caption)
+                else:
+                    await context.bot.send_media_group(chat_id=user_id, media=[media for _, media in group])
+                sent += len(group)
+            except TelegramError as e:
+                logger.error(f"Error sending media group ({len(group)} files) to {user_id}: {e}")
+
+        unsent = len(file_docs) - sent
+        if unsent:
+            await db.update_user_tokens(user_id, unsent * config.TOKENS_PER_FILE) # Refund what didn't arrive
+            await context.bot.send_message(user_id, f"{config.ERROR_EMOJI} Couldn't send {unsent} of the files. Their tokens have not been deducted.")
+        if sent:
+            await query.message.reply_text(f"{config.SUCCESS_EMOJI} {sent} files sent to your PM! Check your chat with me. ({sent * config.TOKENS_PER_FILE} {config.TOKEN_EMOJI} tokens deducted)")
+            log_to_channel(context, f"User {user_id} downloaded {sent} files from a results page. Tokens left: {tokens_left + unsent * config.TOKENS_PER_FILE}")
+        return
+
+    if action in (CB_FILTER_SELECT, CB_FILTER_VALUE):
+        filter_code_bytes = payload[:1]
+        db_field = FILTER_FIELD_MAP.get(filter_code_bytes.decode("ascii", "replace"))
+        if not db_field: return
 
-        other_filters_dict = {k:v for k,v in search_state["filters"].items() if k != db_field and v} # Renamed local var
-        distinct_values = await db.get_distinct_values(db_field, search_state["query"], other_filters_dict)
+    # --- Filter Selection Trigger ---
+    if action == CB_FILTER_SELECT:
+        # get_distinct_values skips empty filters and db_field's own filter itself
+        distinct_values = await db.get_distinct_values(db_field, search_state["query"], search_state["filters"]._asdict())
         
         if not distinct_values:
             await query.answer(f"No specific {db_field} options found for this search.", show_alert=True)
@@ -559,41 +910,35 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         filter_choice_buttons = []
         row = []
         for val in distinct_values:
-            row.append(InlineKeyboardButton(str(val), callback_data=f"{FILTER_PREFIX}{filter_type_code}_val_{val}"))
+            value_data = pack_callback_data(CB_FILTER_VALUE, filter_code_bytes + str(val).encode())
+            if len(value_data) > CALLBACK_DATA_LIMIT: # Telegram would reject the whole keyboard
+                continue
+            row.append(InlineKeyboardButton(str(val), callback_data=value_data))
             if len(row) == 3:
                 filter_choice_buttons.append(row)
                 row = []
         if row: 
             filter_choice_buttons.append(row)
         
-        filter_choice_buttons.append([InlineKeyboardButton(f"All / Clear this filter", callback_data=f"{FILTER_PREFIX}{filter_type_code}_val_CLEAR")])
-        filter_choice_buttons.append([InlineKeyboardButton(f"{config.ERROR_EMOJI} Back to results", callback_data=f"{CANCEL_PREFIX}filter_selection")])
+        filter_choice_buttons.append([InlineKeyboardButton(f"All / Clear this filter", callback_data=pack_callback_data(CB_FILTER_VALUE, filter_code_bytes))])
+        filter_choice_buttons.append([InlineKeyboardButton(f"{config.ERROR_EMOJI} Back to results", callback_data=_CB_BACK_TO_RESULTS)])
         
         reply_markup = InlineKeyboardMarkup(filter_choice_buttons)
         try:
-            await query.edit_message_text(f"Choose {db_field.title()} for '`{search_state['query']}`':", reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+            await query.edit_message_text(f"Choose {db_field.title()} for '<code>{html.escape(search_state['query'])}</code>':", reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         except TelegramError as e:
              if "Message is not modified" not in str(e): logger.error(f"Err editing for filter selection: {e}")
         return
 
     # --- Filter Value Applied ---
-    if data.startswith(FILTER_PREFIX) and "_val_" in data:
-        parts = data.split(FILTER_PREFIX)[1].split("_val_")
-        filter_type_code = parts[0]
-        chosen_value = parts[1]
-
-        field_map = {QUALITY_FILTER: "quality", LANGUAGE_FILTER: "language", SEASON_FILTER: "season"}
-        db_field = field_map.get(filter_type_code)
-
-        if not db_field: return
-
-        if chosen_value == "CLEAR":
-            search_state["filters"][db_field] = None
-        else:
-            if db_field == "season":
-                try: chosen_value = int(chosen_value)
-                except ValueError: pass 
-            search_state["filters"][db_field] = chosen_value
+    if action == CB_FILTER_VALUE:
+        chosen_value = payload[1:].decode("utf-8", "replace")
+        if not chosen_value: # "All / Clear this filter"
+            chosen_value = None
+        elif db_field == "season":
+            try: chosen_value = int(chosen_value)
+            except ValueError: pass 
+        search_state["filters"] = search_state["filters"]._replace(**{db_field: chosen_value})
         
         search_state["page"] = 1 
         context.user_data[SEARCH_STATE_KEY] = search_state
@@ -601,21 +946,26 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
         return
 
     # --- Pagination ---
-    if data.startswith(PAGE_PREFIX):
-        action = data.split(PAGE_PREFIX)[1]
-        if action == "next":
-            search_state["page"] += 1
-        elif action == "prev":
-            search_state["page"] = max(1, search_state["page"] - 1)
-        
+    if action == CB_PAGE:
+        page = search_state["page"]
+        if payload == PAGE_NEXT:
+            new_page = page + 1
+        elif payload == PAGE_PREV:
+            new_page = max(1, page - 1)
+        else:
+            return
+        # Stale or double-tapped buttons at either end would redraw the same page
+        if new_page == page or new_page > search_state.get("total_pages", new_page):
+            return
+        search_state["page"] = new_page
+
         context.user_data[SEARCH_STATE_KEY] = search_state
         await display_search_results(update, context, search_state)
         return
 
     # --- Cancel Actions ---
-    if data.startswith(CANCEL_PREFIX):
-        action = data.split(CANCEL_PREFIX)[1]
-        if action == "search":
+    if action == CB_CANCEL:
+        if payload == CANCEL_SEARCH:
             try:
                 await query.edit_message_text(f"{config.AOT_EMOJI} Search closed. Feel free to start a new one!", reply_markup=None)
                 if SEARCH_STATE_KEY in context.user_data:
@@ -625,7 +975,7 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
                     logger.info("Tried to close search but message was already gone.")
                 else:
                     raise e
-        elif action == "filter_selection": 
+        elif payload == CANCEL_FILTER_SELECTION:
             await display_search_results(update, context, search_state)
         return
 
@@ -633,7 +983,11 @@ async def button_callback_handler(update: Update, context: ContextTypes.DEFAULT_
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log Errors caused by Updates."""
     logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
-    await log_to_channel(context, f"<b>ERROR:</b> <code>{context.error}</code>\nUpdate: <code>{update}</code>")
+    error_key = f"{type(context.error).__name__}: {context.error}"
+    if error_key not in _RECENT_ERRORS: # A cascade of the same error is posted once per window
+        _RECENT_ERRORS[error_key] = True
+        log_to_channel(context, f"<b>ERROR:</b> <code>{_escape_truncated(str(context.error), LOG_ERROR_DETAIL_CHARS)}</code>\n"
+                                f"Update: <code>{_escape_truncated(str(update), LOG_ERROR_DETAIL_CHARS)}</code>")
     if isinstance(update, Update) and update.effective_user:
         try:
             await context.bot.send_message(
@@ -655,6 +1009,73 @@ async def post_init(application: Application):
     print("Bot commands set!")
     set_telegram_bot(application.bot) 
     print("Telegram Bot instance passed to webserver.")
+    await db.init_db()
+    print("Database indexes ensured.")
+    known_files = await db.load_known_file_ids()
+    print(f"Loaded {known_files} known file IDs for duplicate checks.")
+    # Not application.create_task: Application.stop() waits for those, and these loops never end
+    for _ in range(INDEX_WORKERS):
+        _BACKGROUND_TASKS.append(asyncio.create_task(_index_worker()))
+    if config.LOG_CHANNEL_ID:
+        _BACKGROUND_TASKS.append(asyncio.create_task(log_writer(application.bot)))
+    if config.APP_BASE_URL and config.MODIJI_API_KEY:
+        _BACKGROUND_TASKS.append(asyncio.create_task(shortlink_pool_filler()))
+        print("Verification link pool filler started.")
+
+
+async def run_bot_and_webserver(application: Application) -> None:
+    """
+    Runs polling and the verification webserver on the same event loop.
+    run_polling() would block and own the loop, so the application is started manually instead.
+    SIGINT/SIGTERM only ask the webserver to exit, so the cleanup below always runs.
+    """
+    server = create_embedded_webserver()
+
+    def request_stop():
+        if server.should_exit: # Second signal: stop waiting on open connections
+            server.force_exit = True
+        server.should_exit = True
+        logger.info("Stop signal received, shutting down...")
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_stop)
+        except NotImplementedError: # Windows: Ctrl+C falls back to KeyboardInterrupt in main()
+            pass
+
+    # Serve first, so /healthz answers while post_init builds indexes and preloads file IDs
+    web_task = asyncio.create_task(server.serve())
+    try:
+        await application.initialize()
+        await application.start()
+        if application.post_init: # Only run_polling/run_webhook call post_init by themselves
+            await application.post_init(application)
+        # Telegram holds each getUpdates open for up to 30s (PTB's default is 10s), so an idle bot polls a third as often
+        await application.updater.start_polling(timeout=30, allowed_updates=Update.ALL_TYPES)
+        await web_task # Serves until a stop signal sets should_exit
+    finally:
+        if not web_task.done(): # Startup failed, stop the webserver too
+            server.should_exit = True
+        await asyncio.gather(web_task, return_exceptions=True)
+        # Stop fetching updates before the application stops processing them
+        if application.updater.running:
+            await application.updater.stop()
+        # Index files that were already queued before the workers go away
+        try:
+            await asyncio.wait_for(_INDEX_QUEUE.join(), INDEX_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Shutting down with {_INDEX_QUEUE.qsize()} files still waiting to be indexed.")
+        # Handlers still waiting for queue room give up within INDEX_PUT_RETRY_INTERVAL,
+        # so Application.stop(), which waits for them, can't hang on a full queue
+        _INDEX_STOPPING.set()
+        if application.running:
+            await application.stop()
+        for task in _BACKGROUND_TASKS:
+            task.cancel()
+        await asyncio.gather(*_BACKGROUND_TASKS, return_exceptions=True)
+        await application.shutdown()
+        await close_http_client()
 
 
 # --- Main Bot Function ---
@@ -666,19 +1087,32 @@ def main() -> None:
     if not config.MONGO_URI:
         logger.critical("MONGO_URI environment variable not set. Exiting.")
         return
-    if not config.ADMIN_IDS:
+    if not _ADMIN_IDS:
         logger.warning("ADMIN_IDS not set. Some commands will not be restricted.")
     if not config.DB_CHANNEL_ID:
         logger.warning("DB_CHANNEL_ID not set. Automatic file indexing from a specific channel is disabled.")
 
 
-    application = Application.builder().token(config.BOT_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(config.BOT_TOKEN)
+        .request(ORJSONRequest(connection_pool_size=256)) # Same pool size PTB uses by default
+        .get_updates_request(ORJSONRequest())
+        # Shape outgoing calls just under Telegram's limits (30 msg/s overall, 20 msg/min per group) instead of hitting 429s
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=28, overall_time_period=1,
+            group_max_rate=18, group_time_period=60,
+            max_retries=3
+        ))
+        .post_init(post_init)
+        .build()
+    )
 
     # --- Command Handlers ---
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
-    # Ensure config.ADMIN_IDS is a list/tuple of integers for filters.User
-    admin_user_filter = filters.User(user_id=config.ADMIN_IDS) if config.ADMIN_IDS else filters.NEVER
+    # filters.User keeps its own set; built from the same admin IDs that is_admin checks
+    admin_user_filter = filters.User(user_id=_ADMIN_IDS) if _ADMIN_IDS else filters.NEVER
     application.add_handler(CommandHandler("index", index_command, filters=filters.ChatType.PRIVATE | admin_user_filter))
     application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CommandHandler("tokens", tokens_command))
@@ -697,14 +1131,22 @@ def main() -> None:
         # is correctly handled inside the auto_index_file function.
     )
 
+    # Only file messages are dispatched, so text/stickers/service messages never reach the handler
+    file_message_filter = filters.Document.ALL | filters.VIDEO | filters.AUDIO
+
     application.add_handler(MessageHandler(
-        db_channel_filter | admin_forward_filter,
-        auto_index_file
+        file_message_filter & (db_channel_filter | admin_forward_filter),
+        auto_index_file,
+        block=False # Don't hold up other updates while waiting for room in _INDEX_QUEUE
     ))
 
-    # File Search (text messages in groups, not commands)
+    # File Search (new text messages in groups, not commands or edits)
     # filters.ChatType.GROUPS covers both ChatType.GROUP and ChatType.SUPERGROUP
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS, search_handler))
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND & filters.ChatType.GROUPS
+        & filters.Regex(SEARCH_QUERY_REGEX),
+        search_handler
+    ))
 
     # --- Callback Query Handler ---
     application.add_handler(CallbackQueryHandler(button_callback_handler))
@@ -712,22 +1154,22 @@ def main() -> None:
     # --- Error Handler ---
     application.add_error_handler(error_handler)
 
-    loop = asyncio.get_event_loop()
-    bot_task = loop.create_task(application.run_polling(allowed_updates=Update.ALL_TYPES))
-    webserver_task = loop.create_task(run_webserver())
-
     try:
         logger.info("Bot and Webserver starting...")
-        loop.run_until_complete(asyncio.gather(bot_task, webserver_task))
+        asyncio.run(run_bot_and_webserver(application))
     except KeyboardInterrupt:
         logger.info("Bot shutting down (KeyboardInterrupt)...")
     except Exception as e:
         logger.critical(f"Critical error in main event loop: {e}", exc_info=True)
     finally:
-        if application:
-             loop.run_until_complete(application.shutdown())
+        db.close_connection()
         logger.info("Bot shutdown complete.")
 
 
 if __name__ == "__main__":
+    try:
+        import uvloop # libuv-based event loop, much faster than the default selector loop
+        uvloop.install()
+    except ImportError: # Not available on Windows; fall back to the stdlib loop
+        pass
     main()
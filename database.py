@@ -1,113 +1,388 @@
-from pymongo import MongoClient, UpdateOne
-from pymongo.errors import DuplicateKeyError
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+import asyncio
 import datetime
+from cachetools import LRUCache, TTLCache
 from config import MONGO_URI, DATABASE_NAME, TOKEN_EXPIRY_DURATION
 
-# Initialize MongoDB connection
-client = MongoClient(MONGO_URI)
+MONGO_MAX_POOL_SIZE = 50
+
+# Initialize MongoDB connection (one shared async client; pool sized for concurrent handlers).
+# Motor attaches to the running event loop on first use, so creating it at import time is fine.
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=10,
+    maxIdleTimeMS=60000,
+    serverSelectionTimeoutMS=3000,
+    waitQueueTimeoutMS=5000,
+    retryWrites=True
+)
 db = client[DATABASE_NAME]
 
+# Caps in-flight search/user queries at the pool size, so bursts wait here (cache hits don't)
+# instead of piling up in the driver's connection wait queue and timing out.
+_db_sem = asyncio.Semaphore(MONGO_MAX_POOL_SIZE)
+
+async def _bounded(operation):
+    """
+    Runs one database operation while holding a _db_sem permit.
+    Takes a zero-argument callable: Motor starts the query as soon as its method is called,
+    so the call itself has to happen inside the semaphore.
+    """
+    async with _db_sem:
+        return await operation()
+
 # Collections
 files_collection = db["files"]
 users_collection = db["users"]
 pending_verifications_collection = db["pending_verifications"] # For shortener tokens
 
-# Create indexes for faster queries
-files_collection.create_index("file_id", unique=True)
-files_collection.create_index([("file_name_normalized", "text"), ("caption_normalized", "text")]) # For text search
-files_collection.create_index("series_name")
-files_collection.create_index("quality")
-files_collection.create_index("language")
-users_collection.create_index("user_id", unique=True)
-pending_verifications_collection.create_index("verification_token", unique=True)
-pending_verifications_collection.create_index("user_id")
-pending_verifications_collection.create_index("expires_at", expireAfterSeconds=0) # Auto-delete expired tokens
+async def init_db():
+    """Creates indexes for faster queries. Call once at startup, inside the event loop."""
+    # Independent commands, so send them all at once instead of one round-trip after another
+    await asyncio.gather(
+        files_collection.create_index("file_id", unique=True),
+        files_collection.create_index([("file_name_normalized", "text"), ("caption_normalized", "text")]), # For text search
+        files_collection.create_index([("series_name", 1), ("season", 1), ("quality", 1), ("language", 1)]), # Filter combinations within a series
+        files_collection.create_index([("series_name", 1), ("season", 1), ("episode", 1)]), # Series browsing in episode order
+        files_collection.create_index([("quality", 1), ("language", 1)]), # Browsing by filters without a series
+        files_collection.create_index("language"),
+        files_collection.create_index("indexed_at"), # Newest-first listing when there's no query
+        users_collection.create_index("user_id", unique=True),
+        pending_verifications_collection.create_index("verification_token", unique=True),
+        pending_verifications_collection.create_index("user_id"),
+        pending_verifications_collection.create_index("expires_at", expireAfterSeconds=0), # Auto-delete expired tokens
+    )
+
+# In-process caches for hot user lookups (single bot process, so invalidation on write is enough)
+USER_CACHE_TTL = 60 # seconds
+TOKEN_CACHE_TTL = 10 # seconds
+_user_cache = TTLCache(maxsize=10000, ttl=USER_CACHE_TTL)
+_token_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+
+# user_ids known to have a user document, so ensure_user can skip the upsert.
+# Users are never deleted, so entries stay valid for the whole process lifetime.
+KNOWN_USERS_MAX = 500000
+_known_users = LRUCache(maxsize=KNOWN_USERS_MAX)
+
+# Recently seen file_ids, so re-forwarded files are rejected without a DB round-trip.
+# Exact (no false positives) and bounded; older ids simply fall back to the unique index.
+KNOWN_FILE_IDS_MAX = 200000
+_known_file_ids = LRUCache(maxsize=KNOWN_FILE_IDS_MAX)
+
+# add_file calls waiting to be written; flushed together by _file_write_flusher
+FILE_WRITE_BATCH_SIZE = 500
+FILE_WRITE_BATCH_DELAY = 0.2 # seconds to wait for more files before writing a partial batch
+_pending_file_writes = [] # (file_data, future) pairs
+_file_write_flusher_task = None
+
+# Full file documents by _id. Files are write-once after indexing, so no TTL is needed.
+_file_doc_cache = LRUCache(maxsize=2048)
+
+# Paginated search results, so Prev/Next and back-navigation reuse fetched pages.
+# Cleared whenever a new file is indexed.
+SEARCH_CACHE_TTL = 30 # seconds
+_search_cache = TTLCache(maxsize=1024, ttl=SEARCH_CACHE_TTL)
+
+# Distinct filter values per (field(s), normalized query, active filters). Also cleared when a new file is indexed.
+DISTINCT_CACHE_TTL = 60 # seconds
+_distinct_cache = TTLCache(maxsize=10000, ttl=DISTINCT_CACHE_TTL)
+
+# Fields needed to render a search result page and send it as an album.
+# _id is kept (included by default): download buttons carry it.
+SEARCH_RESULT_PROJECTION = {"file_id": 1, "file_name": 1, "file_type": 1}
+# Single-file lookups skip the search-only fields, which can be as large as the rest of the document
+FILE_DOC_PROJECTION = {"file_name_normalized": 0, "caption_normalized": 0, "caption": 0}
 
 # --- File Operations ---
 async def add_file(file_data):
-    """Adds a file to the database. Prevents duplicates based on file_id."""
+    """
+    Adds a file to the database. Prevents duplicates based on file_id.
+    Concurrent calls are coalesced into a single bulk_write; returns True if the file was new.
+    """
+    if file_data["file_id"] in _known_file_ids:
+        return False # Seen recently, no need to ask MongoDB
+    # Add normalized fields for case-insensitive search and better matching
+    file_data["file_name_normalized"] = file_data.get("file_name", "").lower()
+    file_data["caption_normalized"] = file_data.get("caption", "").lower()
+    file_data["indexed_at"] = datetime.datetime.utcnow()
+
+    global _file_write_flusher_task
+    future = asyncio.get_running_loop().create_future()
+    _pending_file_writes.append((file_data, future))
+    if _file_write_flusher_task is None:
+        _file_write_flusher_task = asyncio.create_task(_file_write_flusher())
+    return await future
+
+async def add_files_bulk(file_data_list):
+    """
+    Adds many files at once. Returns one entry per file: True if it was new, False if it was
+    already stored, or the exception that file's write failed with (the others still go through).
+    The files share add_file's write batches, so this costs one bulk_write per FILE_WRITE_BATCH_SIZE files.
+    """
+    return list(await asyncio.gather(*(add_file(file_data) for file_data in file_data_list), return_exceptions=True))
+
+async def _file_write_flusher():
+    """Drains _pending_file_writes in batches, waiting briefly for more files to arrive first."""
+    global _file_write_flusher_task
     try:
-        # Add normalized fields for case-insensitive search and better matching
-        file_data["file_name_normalized"] = file_data.get("file_name", "").lower()
-        file_data["caption_normalized"] = file_data.get("caption", "").lower()
-        file_data["indexed_at"] = datetime.datetime.utcnow()
-        files_collection.insert_one(file_data)
-        return True
-    except DuplicateKeyError:
-        return False # File already exists
-
-async def get_file_by_id(file_id):
-    """Retrieves a file by its Telegram file_id."""
-    return files_collection.find_one({"file_id": file_id})
+        while _pending_file_writes:
+            if len(_pending_file_writes) < FILE_WRITE_BATCH_SIZE:
+                await asyncio.sleep(FILE_WRITE_BATCH_DELAY)
+            batch = _pending_file_writes[:FILE_WRITE_BATCH_SIZE]
+            del _pending_file_writes[:FILE_WRITE_BATCH_SIZE]
+            await _write_file_batch(batch)
+    finally:
+        _file_write_flusher_task = None
+
+async def _write_file_batch(batch):
+    """Upserts a batch of (file_data, future) pairs and resolves each future with whether the file was new."""
+    # $setOnInsert upserts only write when the file_id is new; duplicates are no-ops, not errors
+    operations = [
+        UpdateOne({"file_id": file_data["file_id"]}, {"$setOnInsert": file_data}, upsert=True)
+        for file_data, _ in batch
+    ]
+    failed = {}
+    try:
+        upserted = (await files_collection.bulk_write(operations, ordered=False)).upserted_ids
+    except BulkWriteError as e:
+        # Unordered: everything else was applied. Duplicate keys are lost races with a concurrent upsert.
+        upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+        failed = {err["index"]: e for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+
+    for index, (file_data, future) in enumerate(batch):
+        if index in failed:
+            if not future.done():
+                future.set_exception(failed[index])
+            continue
+        _known_file_ids[file_data["file_id"]] = True
+        if not future.done():
+            future.set_result(index in upserted)
+    if upserted:
+        _search_cache.clear()
+        _distinct_cache.clear()
+
+async def load_known_file_ids(limit=KNOWN_FILE_IDS_MAX):
+    """Seeds the known file_id cache with the most recently indexed files. Returns how many were loaded."""
+    cursor = files_collection.find({}, {"file_id": 1, "_id": 0}).sort("_id", -1).limit(limit)
+    file_ids = [doc["file_id"] async for doc in cursor]
+    for file_id in reversed(file_ids): # Oldest first, so the newest are evicted last
+        _known_file_ids[file_id] = True
+    return len(file_ids)
+
+def _filters_key(filters, exclude=None):
+    """Hashable, order-independent form of the active (non-empty) filters, for cache keys."""
+    if not filters:
+        return ()
+    return tuple(sorted((k, v) for k, v in filters.items() if v and k != exclude))
+
+async def get_file_by_object_id(object_id):
+    """Retrieves a file by its document _id (used by download buttons). Found documents are cached."""
+    file_doc = _file_doc_cache.get(object_id)
+    if file_doc is None:
+        file_doc = await files_collection.find_one({"_id": object_id}, FILE_DOC_PROJECTION)
+        if file_doc:
+            _file_doc_cache[object_id] = file_doc
+    return file_doc
+
+def _normalize_query(query):
+    """Lowercased, stripped search text ("" for none). Text search is case-insensitive, so this also keys the caches."""
+    return (query or "").strip().lower()
 
 async def find_files(query, filters=None, page=1, page_size=10):
-    """Searches for files with text search and applies filters. Supports pagination."""
+    """Searches for files with text search and applies filters. Supports pagination. Results are cached briefly."""
+    query = _normalize_query(query)
+    cache_key = (query, _filters_key(filters), page, page_size)
+    cached = _search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     search_criteria = {}
-    if query:
-        search_criteria["$text"] = {"$search": query.lower()} # Use text index
+    if query: # Without search text, leave the planner free to pick a filter index
+        search_criteria["$text"] = {"$search": query} # Use text index
 
     if filters:
         for key, value in filters.items():
             if value: # Only add filter if a value is provided
                 search_criteria[key] = value
 
-    total_files = files_collection.count_documents(search_criteria)
-    results = list(files_collection.find(search_criteria)
-                   .skip((page - 1) * page_size)
-                   .limit(page_size))
+    projection = dict(SEARCH_RESULT_PROJECTION)
+    if query:
+        projection["score"] = {"$meta": "textScore"}
+
+    cursor = files_collection.find(search_criteria, projection)
+    if query:
+        cursor = cursor.sort([("score", {"$meta": "textScore"})]) # Best matches first
+    else:
+        cursor = cursor.sort("indexed_at", -1) # Newest first, and a stable order across pages
+    # Independent round-trips, so run them concurrently; each uses its own connection, so each takes a permit
+    total_files, results = await asyncio.gather(
+        _bounded(lambda: files_collection.count_documents(search_criteria)),
+        _bounded(lambda: cursor.skip((page - 1) * page_size).limit(page_size).to_list(length=page_size))
+    )
+    _search_cache[cache_key] = (results, total_files)
     return results, total_files
 
 async def count_total_files():
-    return files_collection.count_documents({})
+    return await files_collection.estimated_document_count() # Collection metadata, no scan
 
 async def get_distinct_values(field, query=None, current_filters=None):
-    """Gets distinct values for a field, optionally filtered by a search query and other filters."""
-    pipeline = []
+    """
+    Gets distinct values for a field, optionally filtered by a search query and other filters.
+    current_filters may include `field` itself and empty values; both are ignored. Cached briefly.
+    """
+    query = _normalize_query(query)
+    cache_key = (field, query, _filters_key(current_filters, exclude=field))
+    cached = _distinct_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     match_stage = {}
 
     if query:
-        match_stage["$text"] = {"$search": query.lower()}
+        match_stage["$text"] = {"$search": query}
 
     if current_filters:
         for key, value in current_filters.items():
             if value and key != field: # Don't filter by the field we're getting distinct values for
                  match_stage[key] = value
-    
-    if match_stage:
-        pipeline.append({"$match": match_stage})
-        
-    pipeline.append({"$match": {field: {"$ne": None, "$ne": ""}}}) # Ensure field exists and is not empty
-    pipeline.append({"$group": {"_id": f"${field}"}})
-    pipeline.append({"$sort": {"_id": 1}})
-    
-    distinct_results = files_collection.aggregate(pipeline)
-    return [doc["_id"] for doc in distinct_results]
+
+    # Native distinct can read the field's index directly; no aggregation pipeline needed
+    async with _db_sem:
+        try:
+            distinct_results = await files_collection.distinct(field, match_stage)
+        except OperationFailure: # Filter the server won't take for distinct, fall back to grouping
+            pipeline = [{"$match": match_stage}] if match_stage else []
+            pipeline.append({"$group": {"_id": f"${field}"}})
+            distinct_results = [doc["_id"] for doc in await files_collection.aggregate(pipeline).to_list(length=None)]
+    values = sorted(v for v in distinct_results if v not in (None, "")) # Skip missing/empty values
+    _distinct_cache[cache_key] = values
+    return values
+
+async def get_distinct_values_multi(fields, query=None, current_filters=None):
+    """
+    Gets distinct values for several fields in a single $facet aggregation.
+    Like get_distinct_values, each field's values ignore that field's own filter.
+    Returns a dict of field -> sorted list of values. Cached briefly.
+    """
+    fields = tuple(fields)
+    query = _normalize_query(query)
+    cache_key = (fields, query, _filters_key(current_filters))
+    cached = _distinct_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    base_match = {}
+    facet_filters = {} # Filters on the requested fields, applied per facet
+
+    if query:
+        base_match["$text"] = {"$search": query} # $text must be in the first stage
+
+    if current_filters:
+        for key, value in current_filters.items():
+            if value:
+                if key in fields:
+                    facet_filters[key] = value
+                else:
+                    base_match[key] = value
+
+    pipeline = []
+    if base_match:
+        pipeline.append({"$match": base_match})
+
+    facets = {}
+    for field in fields:
+        facet_match = {k: v for k, v in facet_filters.items() if k != field}
+        facet_match[field] = {"$nin": [None, ""]} # Ensure field exists and is not empty
+        facets[field] = [
+            {"$match": facet_match},
+            {"$group": {"_id": f"${field}"}},
+            {"$sort": {"_id": 1}}
+        ]
+    pipeline.append({"$facet": facets})
+
+    async with _db_sem:
+        facet_results = await files_collection.aggregate(pipeline).to_list(length=1)
+    facet_result = facet_results[0] if facet_results else {}
+    values = {field: [doc["_id"] for doc in facet_result.get(field, [])] for field in fields}
+    _distinct_cache[cache_key] = values
+    return values
 
 
 # --- User and Token Operations ---
 async def get_or_create_user(user_id, username=None, first_name=None):
-    """Gets a user or creates a new one if they don't exist."""
-    user = users_collection.find_one_and_update(
-        {"user_id": user_id},
-        {"$setOnInsert": {"user_id": user_id, "username": username, "first_name": first_name, "tokens": 0, "joined_at": datetime.datetime.utcnow()}},
-        upsert=True,
-        return_document=True # pymongo.ReturnDocument.AFTER
-    )
+    """
+    Gets a user or creates a new one if they don't exist.
+    Cached for USER_CACHE_TTL seconds; the cached "tokens" field may be stale, use get_user_tokens.
+    """
+    user = _user_cache.get(user_id)
+    if user is None:
+        async with _db_sem:
+            user = await users_collection.find_one_and_update(
+                {"user_id": user_id},
+                {"$setOnInsert": {"user_id": user_id, "username": username, "first_name": first_name, "tokens": 0, "joined_at": datetime.datetime.utcnow()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER # Full document, including the token balance
+            )
+        _user_cache[user_id] = user
+        _token_cache[user_id] = user.get("tokens", 0)
+        _known_users[user_id] = True
     return user
 
-async def get_user_tokens(user_id):
-    """Gets the token balance for a user."""
-    user = await get_or_create_user(user_id)
-    return user.get("tokens", 0)
+async def ensure_user(user_id, username=None, first_name=None):
+    """Makes sure a user document exists, without a database round-trip for users already seen."""
+    if user_id in _known_users:
+        return
+    await get_or_create_user(user_id, username, first_name)
+
+async def get_user_tokens(user_id, username=None, first_name=None):
+    """Gets the token balance for a user, creating the user if needed. Cached for TOKEN_CACHE_TTL seconds."""
+    tokens = _token_cache.get(user_id)
+    if tokens is None:
+        # A plain read for existing users; only new users need the upsert
+        async with _db_sem:
+            user = await users_collection.find_one({"user_id": user_id}, {"tokens": 1, "_id": 0})
+        if user is None:
+            _user_cache.pop(user_id, None)
+            user = await get_or_create_user(user_id, username, first_name)
+        else:
+            _known_users[user_id] = True
+        tokens = user.get("tokens", 0)
+        _token_cache[user_id] = tokens
+    return tokens
 
 async def update_user_tokens(user_id, amount_change):
     """Updates a user's token balance. Can be positive or negative."""
-    users_collection.update_one({"user_id": user_id}, {"$inc": {"tokens": amount_change}})
+    await users_collection.update_one({"user_id": user_id}, {"$inc": {"tokens": amount_change}})
+    _token_cache.pop(user_id, None)
+
+async def try_debit_tokens(user_id, cost):
+    """
+    Atomically deducts `cost` tokens if the user has at least that many.
+    Returns the new balance, or None if the balance was insufficient (nothing is deducted).
+    """
+    user = await users_collection.find_one_and_update(
+        {"user_id": user_id, "tokens": {"$gte": cost}},
+        {"$inc": {"tokens": -cost}},
+        return_document=ReturnDocument.AFTER
+    )
+    if user is None:
+        _token_cache.pop(user_id, None)
+        return None
+    _token_cache[user_id] = user["tokens"]
+    return user["tokens"]
 
 async def add_pending_verification(user_id, verification_token):
     """Stores a pending verification token for a user."""
     expires_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=TOKEN_EXPIRY_DURATION)
-    pending_verifications_collection.insert_one({
+    await pending_verifications_collection.insert_one({
         "user_id": user_id,
         "verification_token": verification_token,
         "created_at": datetime.datetime.utcnow(),
@@ -118,15 +393,20 @@ async def get_pending_verification(verification_token):
     """Retrieves and removes a pending verification token if it exists and hasn't expired."""
     # MongoDB's TTL index will handle actual expiry deletion.
     # We still check here to avoid race conditions or processing already "logically" expired tokens.
-    return pending_verifications_collection.find_one_and_delete({
+    return await pending_verifications_collection.find_one_and_delete({
         "verification_token": verification_token,
         "expires_at": {"$gt": datetime.datetime.utcnow()}
     })
 
 async def count_total_users():
-    return users_collection.count_documents({})
+    return await users_collection.estimated_document_count() # Collection metadata, no scan
+
+# --- Connection ---
+def close_connection():
+    """Closes the MongoDB client and its connection pool."""
+    client.close()
 
 # --- Stats ---
 async def get_db_stats():
     """Gets database statistics (size)."""
-    return db.command("dbstats")
+    return await db.command("dbstats")
@@ -1,5 +1,8 @@
 import re
+import base64
+import binascii
 import secrets
+import functools
 import httpx # For making API calls to link shortener
 from urllib.parse import urljoin
 from config import MODIJI_API_KEY, MODIJI_API_URL, APP_BASE_URL, VERIFICATION_ENDPOINT
@@ -12,8 +15,15 @@ FILE_METADATA_REGEX = re.compile(
     r"^(.*?)(?:[Ss](\d+))?[EeXx]?(\d+)(?:.*?\[(\d{3,4}p)\].*?)?(?:.*?\[(SUB|DUB)\].*?)?$",
     re.IGNORECASE
 )
-# Alternative for just series name if above fails
-SERIES_NAME_REGEX = re.compile(r"^(.*?)(?:[Ss]\d+)?(?:[EeXx]\d+)?", re.IGNORECASE)
+# Leading bracketed source tags like [HorribleSubs]
+SOURCE_TAG_REGEX = re.compile(r"^\[.*?\]\s*")
+# Dots and underscores are treated as word separators
+_SEPARATOR_TABLE = str.maketrans("._", "  ")
+# Fallback quality/language keywords, found in one pass over the lowercased filename.
+# The tuples give precedence when several keywords appear.
+QUALITY_KEYWORDS = ("1080p", "720p", "480p")
+LANGUAGE_KEYWORDS = (("dual audio", "DUAL"), ("dub", "DUB"), ("sub", "SUB")) # Or map DUAL to SUB/DUB as preferred
+KEYWORD_REGEX = re.compile("|".join(re.escape(kw) for kw in QUALITY_KEYWORDS + tuple(kw for kw, _ in LANGUAGE_KEYWORDS)))
 
 
 def parse_filename(filename):
@@ -21,8 +31,13 @@ def parse_filename(filename):
     Parses filename to extract anime metadata.
     Returns a dictionary with: series_name, season, episode, quality, language
     """
+    # Callers may modify the result, so hand out a copy of the cached dict
+    return dict(_parse_filename_cached(filename))
+
+@functools.lru_cache(maxsize=4096) # Same names/captions are often re-parsed (re-forwards, caption fallback)
+def _parse_filename_cached(filename):
     # Normalize: replace dots and underscores with spaces for easier parsing
-    normalized_filename = filename.replace('.', ' ').replace('_', ' ')
+    normalized_filename = filename.translate(_SEPARATOR_TABLE)
     
     match = FILE_METADATA_REGEX.search(normalized_filename)
     data = {
@@ -36,7 +51,7 @@ def parse_filename(filename):
     if match:
         series_candidate = match.group(1).strip()
         # Try to clean up series name from bracketed source tags like [HorribleSubs]
-        series_candidate = re.sub(r"^\[.*?\]\s*", "", series_candidate).strip()
+        series_candidate = SOURCE_TAG_REGEX.sub("", series_candidate).strip()
         data["series_name"] = series_candidate if series_candidate else None
 
         if match.group(2): # Season
@@ -48,40 +63,55 @@ def parse_filename(filename):
         if match.group(5): # Language (SUB/DUB)
             data["language"] = match.group(5).upper()
     
-    # Fallback for series name if the complex regex didn't catch it well
-    if not data["series_name"]:
-        series_match = SERIES_NAME_REGEX.search(normalized_filename)
-        if series_match and series_match.group(1):
-            series_candidate = series_match.group(1).strip()
-            series_candidate = re.sub(r"^\[.*?\]\s*", "", series_candidate).strip()
-            data["series_name"] = series_candidate if series_candidate else None
-            
     # If series_name is still None, use the original filename (without extension) as a last resort
     if not data["series_name"] and filename:
         data["series_name"] = filename.rsplit('.', 1)[0].strip()
 
 
     # Basic quality/language detection from filename if not caught by regex
-    fn_lower = filename.lower()
-    if not data["quality"]:
-        if "1080p" in fn_lower: data["quality"] = "1080p"
-        elif "720p" in fn_lower: data["quality"] = "720p"
-        elif "480p" in fn_lower: data["quality"] = "480p"
-    
-    if not data["language"]:
-        if "sub" in fn_lower: data["language"] = "SUB"
-        if "dub" in fn_lower: data["language"] = "DUB"
-        if "dual audio" in fn_lower: data["language"] = "DUAL" # Or map to SUB/DUB as preferred
+    if not (data["quality"] and data["language"]):
+        found = set(KEYWORD_REGEX.findall(filename.lower()))
+        if not data["quality"]:
+            data["quality"] = next((kw for kw in QUALITY_KEYWORDS if kw in found), None)
+        if not data["language"]:
+            data["language"] = next((lang for kw, lang in LANGUAGE_KEYWORDS if kw in found), None)
 
     return data
 
 
+# --- Callback Data Codec ---
+def pack_callback_data(tag, payload=b""):
+    """Encodes a 1-byte action tag and binary payload as compact, URL-safe callback_data."""
+    return base64.urlsafe_b64encode(bytes([tag]) + payload).decode("ascii")
+
+def unpack_callback_data(data):
+    """Decodes callback_data from pack_callback_data. Returns (tag, payload), or None if it's not valid."""
+    try:
+        raw = base64.urlsafe_b64decode(data)
+    except (binascii.Error, ValueError):
+        return None
+    if not raw:
+        return None
+    return raw[0], raw[1:]
+
+
 # --- Token Generation ---
 def generate_verification_token():
     """Generates a secure random token for link shortener verification."""
     return secrets.token_urlsafe(24) # Generates a 32-char URL-safe string
 
 # --- Link Shortener ---
+# One pooled client for all shortener calls, so connections (and their TLS sessions) are reused
+_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+)
+
+async def close_http_client():
+    """Closes the shared shortener HTTP client. Call once on shutdown."""
+    await _http_client.aclose()
+
 async def shorten_link(target_url):
     """
     Shortens a link using ModijiURL API (or your chosen service).
@@ -95,20 +125,18 @@ async def shorten_link(target_url):
         "key": MODIJI_API_KEY,
         "url": target_url
     }
-    # Example using httpx (async http client)
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(MODIJI_API_URL, json=payload) # Or data=payload, check API docs
-            response.raise_for_status() # Raises HTTPError for bad responses (4XX or 5XX)
-            result = response.json()
-            # Assuming API returns something like: {"short_url": "http://modi.ji/xyz"}
-            return result.get("short_url", target_url)
-        except httpx.RequestError as e:
-            print(f"Error calling ModijiURL API: {e}")
-            return target_url # Fallback to original URL on error
-        except Exception as e:
-            print(f"Error processing ModijiURL response: {e}")
-            return target_url
+    try:
+        response = await _http_client.post(MODIJI_API_URL, json=payload) # Or data=payload, check API docs
+        response.raise_for_status() # Raises HTTPError for bad responses (4XX or 5XX)
+        result = response.json()
+        # Assuming API returns something like: {"short_url": "http://modi.ji/xyz"}
+        return result.get("short_url", target_url)
+    except httpx.RequestError as e:
+        print(f"Error calling ModijiURL API: {e}")
+        return target_url # Fallback to original URL on error
+    except Exception as e:
+        print(f"Error processing ModijiURL response: {e}")
+        return target_url
 
 def get_verification_callback_url(verification_token):
     """Constructs the full callback URL for the link shortener."""
@@ -119,12 +147,9 @@ def get_verification_callback_url(verification_token):
     return f"{base}/{endpoint}?token={verification_token}"
 
 # --- Pagination Helper ---
+BYTE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
 def format_bytes(size):
-    # 2**10 = 1024
-    power = 2**10
-    n = 0
-    power_labels = {0 : '', 1: 'KB', 2: 'MB', 3: 'GB', 4: 'TB'}
-    while size > power:
-        size /= power
-        n += 1
-    return f"{size:.2f} {power_labels[n]}"
+    # Each unit is 2**10 = 1024 times the previous one, so the unit index is the bit length // 10
+    n = 0 if size < 1 else min((int(size).bit_length() - 1) // 10, len(BYTE_UNITS) - 1)
+    return f"{size / 1024**n:.2f} {BYTE_UNITS[n]}"
@@ -1,7 +1,8 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
 import uvicorn
 import asyncio
+import contextlib
 
 from telegram import Bot
 
@@ -12,7 +13,7 @@ from config import (
 )
 
 # Initialize FastAPI app
-web_app = FastAPI()
+web_app = FastAPI(default_response_class=ORJSONResponse) # orjson for any JSON responses (orjson is already a dependency)
 telegram_bot_instance = None # Will be set by bot.py
 
 def set_telegram_bot(bot_instance: Bot):
@@ -49,13 +50,13 @@ async def verify_callback(request: Request, token: str = None):
 
     success_message = (
         f"{SUCCESS_EMOJI} Verification Successful! {NARUTO_EMOJI}\n\n"
-        f"You've earned **{TOKENS_PER_VERIFICATION} {TOKEN_EMOJI} tokens!**\n"
+        f"You've earned <b>{TOKENS_PER_VERIFICATION} {TOKEN_EMOJI} tokens!</b>\n"
         f"Use /tokens to check your new balance."
     )
     
     if telegram_bot_instance:
         try:
-            await telegram_bot_instance.send_message(chat_id=user_id, text=success_message, parse_mode='Markdown')
+            await telegram_bot_instance.send_message(chat_id=user_id, text=success_message, parse_mode='HTML')
         except Exception as e:
             print(f"Error sending verification success PM to {user_id}: {e}")
             # User might have blocked the bot, that's okay.
@@ -70,14 +71,39 @@ async def verify_callback(request: Request, token: str = None):
         status_code=200
     )
 
+class EmbeddedServer(uvicorn.Server):
+    """
+    Uvicorn server for running inside bot.py's event loop, which owns SIGINT/SIGTERM.
+    Stock uvicorn (0.29+) captures the signals and re-raises them after serving, which would kill
+    the process before the bot's cleanup runs; the host sets `should_exit` instead.
+    """
+
+    def install_signal_handlers(self): # uvicorn < 0.29
+        pass
+
+    @contextlib.contextmanager
+    def capture_signals(self): # uvicorn >= 0.29
+        yield
+
+    async def serve(self, sockets=None):
+        try:
+            await super().serve(sockets)
+        except SystemExit as e: # Uvicorn exits the process when startup fails (e.g. port in use)
+            raise RuntimeError(f"Webserver failed to start (exit code {e.code})") from None
+
+def _uvicorn_config():
+    # No lifespan handlers are registered, so skip the lifespan protocol task
+    return uvicorn.Config(web_app, host="0.0.0.0", port=PORT, log_level="info", lifespan="off")
+
+def create_embedded_webserver():
+    """Builds the webserver for bot.py. Await its serve(); set its should_exit to stop it."""
+    print(f"🚀 Webserver starting on port {PORT}...")
+    return EmbeddedServer(_uvicorn_config())
+
 async def run_webserver():
-    """Runs the FastAPI web server using Uvicorn."""
-    config = uvicorn.Config(web_app, host="0.0.0.0", port=PORT, log_level="info")
-    server = uvicorn.Server(config)
+    """Runs the FastAPI web server using Uvicorn, with Uvicorn's own signal handling (standalone use)."""
+    server = uvicorn.Server(_uvicorn_config())
     print(f"🚀 Webserver starting on port {PORT}...")
-    # Running uvicorn in a separate thread or using asyncio.create_task
-    # is better if you want it non-blocking with the bot's polling.
-    # For Koyeb, this will likely be the main process.
     await server.serve()
 
 if __name__ == "__main__":